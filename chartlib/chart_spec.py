@@ -1,3 +1,11 @@
+import collections
+import contextlib
+import functools
+import hashlib
+import json
+import re
+import threading
+
 import altair as alt
 import numpy as np
 import pandas as pd
@@ -5,28 +13,163 @@ import pandas as pd
 from .dot_dict import DotDict
 
 
-def _fontSettings(font):
-    return lambda: {
-        "config": {
-            "title": {'font': font},
-            "axis": {
-                "labelFont": font,
-                "titleFont": font
-            },
-            "header": {
-                "labelFont": font,
-                "titleFont": font
-            },
-            "legend": {
-                "labelFont": font,
-                "titleFont": font
-            }
+def _fontConfig(font):
+    return {
+        "title": {'font': font},
+        "axis": {
+            "labelFont": font,
+            "titleFont": font
+        },
+        "header": {
+            "labelFont": font,
+            "titleFont": font
+        },
+        "legend": {
+            "labelFont": font,
+            "titleFont": font
         }
     }
 
 
-def _ensure_parens(expr):
-    return f'({expr})'
+_COLOR_SCHEME_HEX = (
+    "4e79a7f28e2ce1575976b7b259a14fedc949af7aa1ff9da79c755fbab0ab"
+    "1f77b4ff7f0e2ca02cd627289467bd8c564be377c27f7f7fbcbd2217becf"
+    "a6cee31f78b4b2df8a33a02cfb9a99e31a1cfdbf6fff7f00cab2d66a3d9affff99b15928"
+    "7fc97fbeaed4fdc086ffff99386cb0f0027fbf5b17666666"
+    "1b9e77d95f027570b3e7298a66a61ee6ab02a6761d666666"
+)
+
+
+def _and(*conditions):
+    # falsy conditions are dropped so that optional clauses can be passed inline
+    return '(' + ' && '.join(c for c in conditions if c) + ')'
+
+
+# A single emoji, possibly glued to further code points by zero-width joiners / variation selectors.
+_EMOJI_RE = re.compile('.(?:[\u200d\ufe0f]+.?)*', re.DOTALL)
+
+
+_EMOJI_DESCRIPTIONS = {
+    '👨‍👩‍👧‍👦': 'Gatherings banned',
+    '🏠': 'Stay-at-home order',
+    '🍔': 'Restaurant closures',
+    '🏬': 'Business closures',
+    '⚠️': 'Emergency declaration',
+    '🎓': 'School closures',
+    '🛩': 'Travel restrictions',
+    '💼': 'Visitor/Border restrictions',
+    '🛃': 'Forgot what this meant',
+}
+_EMOJI_AND_DESCRIPTION_EXPR = f'datum.emoji + " " + {json.dumps(_EMOJI_DESCRIPTIONS, ensure_ascii=False)}[datum.emoji]'
+
+# y position of the rule separating the emoji legend from the chart, by number of emoji legend rows
+_EMOJI_LEGEND_SEP_Y = (None, '2', '4', '7')
+
+
+def _to_inline_csv(df):
+    # Row-wise JSON repeats every column name on every row; CSV sends them once.
+    # Vega parses CSV fields as strings unless told otherwise, so numeric / boolean
+    # columns are listed explicitly (empty fields parse to null, like NaN in JSON).
+    parse = {}
+    for col, dtype in df.dtypes.items():
+        if pd.api.types.is_bool_dtype(dtype):
+            parse[col] = 'boolean'
+        elif pd.api.types.is_numeric_dtype(dtype):
+            parse[col] = 'number'
+    values = alt.utils.sanitize_dataframe(df).to_csv(index=False)
+    return alt.InlineData(values=values, format=alt.CsvDataFormat(type='csv', parse=parse))
+
+
+def _inline_csv_data_transformer(data, max_rows=5000):
+    # same as altair's default transformer, except that dataframes are embedded as CSV
+    data = alt.limit_rows(data, max_rows=max_rows)
+    if isinstance(data, pd.DataFrame):
+        return _to_inline_csv(data).to_dict()
+    return alt.to_values(data)
+
+
+# lets every chart (not just the main layers of specs with inline_csv set) embed its data as CSV
+# via `alt.data_transformers.enable('inline_csv')`
+alt.data_transformers.register('inline_csv', _inline_csv_data_transformer)
+
+
+def _hashable_spec_value(value):
+    # Spec values as something hashable that only compares equal for equal values.
+    # Raises TypeError for values that can't be represented this way (e.g. numpy arrays).
+    if isinstance(value, dict):
+        return dict, tuple(sorted(
+            ((_hashable_spec_value(k), _hashable_spec_value(v)) for k, v in value.items()), key=repr
+        ))
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(_hashable_spec_value(v) for v in value)
+    if value is not None and type(value).__hash__ is object.__hash__:
+        # hashed by identity, so changes to the object would go unnoticed
+        raise TypeError(f'cannot use {type(value).__name__} in a cache key')
+    hash(value)
+    # the type keeps e.g. True and 1 apart
+    return type(value), value
+
+
+def _set_selections(chart, *selections):
+    # Like chained add_selection() calls, but without copying the chart each time;
+    # only use on charts that were just built and aren't shared with other layers.
+    chart.selection = {selection.name: selection.selection for selection in selections}
+    return chart
+
+
+def _copy_chart_data(chart, copies=None):
+    # chart.copy(deep=True) leaves dataframes shared, so copy those too (once each, wherever they're used)
+    copies = {} if copies is None else copies
+    data = getattr(chart, 'data', alt.Undefined)
+    if isinstance(data, pd.DataFrame):
+        if id(data) not in copies:
+            copies[id(data)] = data.copy()
+        chart.data = copies[id(data)]
+    for attr in ('layer', 'hconcat', 'vconcat', 'concat'):
+        subcharts = getattr(chart, attr, alt.Undefined)
+        if subcharts is not alt.Undefined:
+            for subchart in subcharts:
+                _copy_chart_data(subchart, copies)
+    spec = getattr(chart, 'spec', alt.Undefined)
+    if isinstance(spec, alt.SchemaBase):
+        _copy_chart_data(spec, copies)
+    return chart
+
+
+# Hovering fires mouseover for every voronoi cell crossed, so debounce it: the cursor only updates
+# once the pointer has rested for 50ms, and always ends up on the last cell entered
+# (a plain throttle, `{50}`, could drop that final event and leave the cursor on a stale point).
+# Not for cursors that clear on mouseout though: a pending debounced mouseover would re-select after the clear.
+_CURSOR_EVENTS = 'mouseover{0,50}'
+
+
+def _memoize_per_compile(method):
+    # the cache lives in the transient state, so it is dropped along with it at the end of compile
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        memo = self._compile_memo
+        if memo is None:
+            return method(self, *args)
+        key = (name, *args) if args else name
+        if key not in memo:
+            memo[key] = method(self, *args)
+        return memo[key]
+    return wrapper
+
+
+class _TransientState(object):
+    """
+    Scratch state that only lives for the duration of a single compile.
+    """
+    __slots__ = ('overrides', 'unique_values', 'memo')
+
+    def __init__(self):
+        # spec values that compile derives from the dataframe, taking precedence over the spec's own
+        self.overrides = {}
+        self.unique_values = {}
+        self.memo = None
 
 
 class ChartSpec(DotDict):
@@ -56,27 +199,20 @@ class ChartSpec(DotDict):
     #DEFAULT_BACKGROUND_COLOR = '#F2F6F6'
     DEFAULT_BACKGROUND_COLOR = 'white'
     DEFAULT_MIN_TREND_LINE_DAYS = 5
+    MODEL_Y_INPUT_COLUMNS = ('y', 'lockdown_x', 'lockdown_y', 'lockdown_slope', 'x_start', 'xmax')
     DEFAULT_FONT = 'Khula'
     MAX_LEGEND_MARKS = 33
     MAX_EMOJI_LEGEND_MARKS = 33
     EMPTY_SELECTION = ''
-    COLOR_SCHEME = list(
-        map(
-            lambda y: '#' + y,
-            filter(
-                lambda x: x != '',
-                [(
-                    "4e79a7f28e2ce1575976b7b259a14fedc949af7aa1ff9da79c755fbab0ab"
-                    "1f77b4ff7f0e2ca02cd627289467bd8c564be377c27f7f7fbcbd2217becf"
-                    "a6cee31f78b4b2df8a33a02cfb9a99e31a1cfdbf6fff7f00cab2d66a3d9affff99b15928"
-                    "7fc97fbeaed4fdc086ffff99386cb0f0027fbf5b17666666"
-                    "1b9e77d95f027570b3e7298a66a61ee6ab02a6761d666666"
-                )[i:i+6] for i in range(0, 1000, 6)]
-            )
-        )
-    ) + [
+    COMPILE_CACHE_SIZE = 16
+    COLOR_SCHEME = [
+        '#' + _COLOR_SCHEME_HEX[i:i+6] for i in range(0, len(_COLOR_SCHEME_HEX), 6)
+    ] + [
         'red', 'blue', 'green', 'purple', 'orange',
     ]
+    # compiled charts keyed by spec class + spec + dataframe contents, shared by all specs; see `compile`
+    _compile_cache = collections.OrderedDict()
+    _compile_cache_lock = threading.Lock()
 
     def validate(self, df):
         if 'lines' not in self and 'points' not in self:
@@ -97,6 +233,8 @@ class ChartSpec(DotDict):
             if self.detailby != self.colorby:
                 raise ValueError('when legend selection enabled, detailby and colorby should be identical')
 
+    # encodings are needed by nearly every layer with identical arguments, so build each distinct one once
+    @_memoize_per_compile
     def _get_x(self, shorthand='x:Q'):
         xaxis_kwargs = {}
         if 'xdomain' in self:
@@ -108,13 +246,14 @@ class ChartSpec(DotDict):
             xaxis_kwargs['axis'] = alt.Axis(grid=self['grid'])
         return alt.X(shorthand, **xaxis_kwargs)
 
-    def _get_y(self, shorthand='y:Q', **yaxis_kwargs):
-        if 'scale' not in yaxis_kwargs:
-            yscale = self.get('yscale', 'linear')
-            if 'ydomain' in self:
-                yaxis_kwargs['scale'] = alt.Scale(type=yscale, domain=self.ydomain)
-            else:
-                yaxis_kwargs['scale'] = alt.Scale(type=yscale)
+    @_memoize_per_compile
+    def _get_y(self, shorthand='y:Q'):
+        yaxis_kwargs = {}
+        yscale = self.get('yscale', 'linear')
+        if 'ydomain' in self:
+            yaxis_kwargs['scale'] = alt.Scale(type=yscale, domain=self.ydomain)
+        else:
+            yaxis_kwargs['scale'] = alt.Scale(type=yscale)
         ytitle = self.get('ytitle', None)
         if ytitle is not None:
             yaxis_kwargs['title'] = ytitle
@@ -127,7 +266,14 @@ class ChartSpec(DotDict):
         if transient is None:
             return self.get(key, default)
         else:
-            return transient.get(key, self.get(key, default))
+            return transient.overrides.get(key, self.get(key, default))
+
+    @property
+    def _compile_memo(self):
+        transient = self.get(self.TRANSIENT, None)
+        if transient is None:
+            return None
+        return transient.memo
 
     @property
     def _font(self):
@@ -146,10 +292,12 @@ class ChartSpec(DotDict):
         return self._prefer_transient('colormap')
 
     @property
+    @_memoize_per_compile
     def _alt_detail(self):
         return alt.Detail(f'{self._detailby}:N')
 
     @property
+    @_memoize_per_compile
     def _alt_color(self):
         extra_color_kwargs = {}
         colormap = self._colormap
@@ -179,14 +327,16 @@ class ChartSpec(DotDict):
     def _manual_legend(self):
         return self.get('use_manual_legend', False)
 
+    @_memoize_per_compile
     def _click_is_active(self):
-        return _ensure_parens(' && '.join([
-            f'{str(self.get("click_selection", False)).lower()}',
-            f'isValid({self.click}.{self._detailby})',
-            # f'isDefined({self.click}_{self._detailby})',
-            f'{self.click}.{self._detailby} != "{self.EMPTY_SELECTION}"'
-        ]))
+        return (
+            f'({str(self.get("click_selection", False)).lower()}'
+            f' && isValid({self.click}.{self._detailby})'
+            # f' && isDefined({self.click}_{self._detailby})'
+            f' && {self.click}.{self._detailby} != "{self.EMPTY_SELECTION}")'
+        )
 
+    @_memoize_per_compile
     def _old_legend_is_active(self):
         conditions = [
             f'{str(self.get("legend_selection", False)).lower()}',
@@ -202,52 +352,48 @@ class ChartSpec(DotDict):
             ])
         else:
             conditions.append(f'isValid({self.legend}_{self._detailby}_legend)')
-        return _ensure_parens(' && '.join(conditions))
+        return _and(*conditions)
 
+    @_memoize_per_compile
     def _legend_is_active(self):
         if not self._manual_legend:
             return self._old_legend_is_active()
-        return _ensure_parens(' && '.join([
-            'isValid(legend_hover)',
-            'isValid(legend_hover.group_idx)',
-            'legend_hover.group_idx > -1'
-        ]))
+        return '(isValid(legend_hover) && isValid(legend_hover.group_idx) && legend_hover.group_idx > -1)'
 
+    @_memoize_per_compile
     def _click_focused(self):
-        return _ensure_parens(' && '.join([
-            self._click_is_active(),
-            f'indexof({self.click}.{self._detailby}, datum.{self._detailby}) >= 0'
-            # f'{self.click}.{self._detailby} == datum.{self._detailby}'
-        ]))
+        # f'{self.click}.{self._detailby} == datum.{self._detailby}'
+        return f'({self._click_is_active()} && indexof({self.click}.{self._detailby}, datum.{self._detailby}) >= 0)'
 
+    @_memoize_per_compile
     def _old_legend_focused(self):
-        return _ensure_parens(' && '.join([
-            f'{self._legend_is_active()}',
-            f'indexof({self.legend}.{self._detailby}, datum.{self._detailby}) >= 0'
-        ]))
+        return f'({self._legend_is_active()} && indexof({self.legend}.{self._detailby}, datum.{self._detailby}) >= 0)'
 
+    @_memoize_per_compile
     def _legend_hover_focused(self):
         if not self._manual_legend:
             return self._old_legend_focused()
-        return _ensure_parens(' && '.join([
-            self._legend_is_active(),
-            'datum.group_idx == legend_hover.group_idx'
-        ]))
+        return f'({self._legend_is_active()} && datum.group_idx == legend_hover.group_idx)'
 
+    @_memoize_per_compile
     def _in_focus(self):
-        return _ensure_parens(f'{self._click_focused()} || {self._legend_hover_focused()}')
+        return f'({self._click_focused()} || {self._legend_hover_focused()})'
 
+    @_memoize_per_compile
     def _someone_has_focus(self):
-        return _ensure_parens(f'{self._click_is_active()} || {self._legend_is_active()}')
+        return f'({self._click_is_active()} || {self._legend_is_active()})'
 
+    @_memoize_per_compile
     def _in_focus_or_none_selected(self):
-        return _ensure_parens(f'{self._in_focus()} || !{self._someone_has_focus()}')
+        return f'({self._in_focus()} || !{self._someone_has_focus()})'
 
+    @_memoize_per_compile
     def _click_focused_or_none_selected(self):
-        return _ensure_parens(f'{self._click_focused()} || !{self._someone_has_focus()}')
+        return f'({self._click_focused()} || !{self._someone_has_focus()})'
 
+    @_memoize_per_compile
     def _legend_focused_or_none_selected(self):
-        return _ensure_parens(f'{self._legend_hover_focused()} || !{self._someone_has_focus()}')
+        return f'({self._legend_hover_focused()} || !{self._someone_has_focus()})'
 
     def _show_events(self):
         return 'events.values[0]'
@@ -266,43 +412,45 @@ class ChartSpec(DotDict):
             base = base.facet(column=f'{facetby}:N')
         return base
 
+    @_memoize_per_compile
+    def _plotted_data_predicate(self):
+        return _and(
+            'datum.y !== null',
+            f'datum.x_type == "{self.normal_type}"',
+            self._yscale == 'log' and 'datum.y > 0',
+        )
+
     def _make_line_layer(self, base):
+        get = self.get
         kwargs = dict(x=self._get_x(), y=self._get_y(), detail=self._alt_detail, color=self._alt_color)
-        if not self.get('lines', False):
+        if not get('lines', False):
             kwargs['opacity'] = alt.value(0)
         else:
             kwargs['opacity'] = alt.condition(
                 self._in_focus_or_none_selected(),
                 alt.value(1),
-                alt.value(self.get('unfocused_opacity', self.DEFAULT_UNFOCUSED_OPACITY))
+                alt.value(get('unfocused_opacity', self.DEFAULT_UNFOCUSED_OPACITY))
             )
-        line_layer = base.mark_line(size=3).encode(**kwargs)
-        line_layer = line_layer.transform_filter('datum.y !== null')
-        line_layer = line_layer.transform_filter(f'datum.x_type == "{self.normal_type}"')
-        if self._yscale == 'log':
-            line_layer = line_layer.transform_filter('datum.y > 0')
-        return line_layer
+        return base.mark_line(size=3).encode(**kwargs).transform_filter(self._plotted_data_predicate())
 
     def _make_point_layer(self, base, point_size, is_fake):
+        get = self.get
+        focus_expr = self._in_focus_or_none_selected()
         kwargs = dict(x=self._get_x(), y=self._get_y(), detail=self._alt_detail, color=self._alt_color)
-        if not self.get('points', False) or is_fake:
+        if not get('points', False) or is_fake:
             kwargs['opacity'] = alt.value(0)
         else:
             kwargs['opacity'] = alt.condition(
-                self._in_focus_or_none_selected(),
+                focus_expr,
                 alt.value(.4),
-                alt.value(self.get('unfocused_opacity', self.DEFAULT_UNFOCUSED_OPACITY))
+                alt.value(get('unfocused_opacity', self.DEFAULT_UNFOCUSED_OPACITY))
             )
 
-        point_layer = base.mark_point(size=point_size, filled=True).encode(**kwargs)
-        point_layer = point_layer.transform_filter('datum.y !== null')
-        point_layer = point_layer.transform_filter(f'datum.x_type == "{self.normal_type}"')
-        if self._yscale == 'log':
-            point_layer = point_layer.transform_filter('datum.y > 0')
+        predicate = self._plotted_data_predicate()
         if is_fake and not self._manual_legend:
-            # the first one makes it easier for tooltips to follow since otherwise these guys will stick
-            point_layer = point_layer.transform_filter(self._in_focus_or_none_selected())
-        return point_layer
+            # the focus filter makes it easier for tooltips to follow since otherwise these guys will stick
+            predicate = _and(predicate, focus_expr)
+        return base.mark_point(size=point_size, filled=True).encode(**kwargs).transform_filter(predicate)
 
     def _make_tooltip_text_layer(self, point_layer, cursor):
         return point_layer.mark_text(
@@ -317,7 +465,7 @@ class ChartSpec(DotDict):
             # tooltip_text='datum.y'
         ).transform_filter(self._in_focus())
 
-    def _collect_lockdown_icon_layers(self, df, layers, base):
+    def _collect_lockdown_icon_layers(self, df, base):
         ycol = 'y'
         if 'event_index' in df.columns:
             ycol = 'event_index_y'
@@ -326,7 +474,7 @@ class ChartSpec(DotDict):
             ret = base.mark_image(height=size, width=size).encode(
                 x=self._get_x(), y=self._get_y(f'{ycol}:Q'),
                 opacity=alt.value(1),
-                url='image_url'
+                url='image_url:N'
             )
             if 'event_index' in df.columns:
                 ret = ret.transform_calculate(**{
@@ -337,10 +485,12 @@ class ChartSpec(DotDict):
             return ret
         icons = _make_base(size=25)
         if 'Coverage' in df.columns:
-            layers['statewide_lockdown_icons'] = icons.transform_filter('datum.Coverage == "Statewide"')
-            layers['regional_lockdown_icons'] = _make_base(size=20).transform_filter('datum.Coverage != "Statewide"')
+            return [
+                icons.transform_filter('datum.Coverage == "Statewide"'),
+                _make_base(size=20).transform_filter('datum.Coverage != "Statewide"'),
+            ]
         else:
-            layers['lockdown_icons'] = icons
+            return [icons]
 
     def _make_lockdown_rules_layer(self, base, do_mark=True):
         if do_mark:
@@ -349,7 +499,7 @@ class ChartSpec(DotDict):
             self._get_x(), detail=self._alt_detail, color=self._alt_color,
         )
 
-    def _collect_lockdown_tooltip_layers(self, df, layers, base, cursor):
+    def _collect_lockdown_tooltip_layers(self, df, base, cursor):
         # Since it's difficult to support a condition of type 'mouseover OR checkbox'
         # (due to broken alt.condition not two non-constants for if_true and if_false
         # and due to completely broken checkboxes in Vega Lite), we'll add two layers
@@ -366,7 +516,7 @@ class ChartSpec(DotDict):
             ).transform_calculate(
     # AGP        lockdown_tooltip_text=f'datum.{self._detailby} + " " + datum.lockdown_type+ " " +"("+ datum.lockdown_date + ")"'
                  # lockdown_tooltip_text=f'datum.lockdown_type+ " " +"("+ datum.lockdown_date + ")"'
-                 lockdown_tooltip_text='datum.lockdown_type + " " + "(" + datum.lockdown_date + ")"'
+                 lockdown_tooltip_text='datum.lockdown_type + " (" + datum.lockdown_date + ")"'
             )
             if 'event_index' in df.columns:
                 ret = ret.transform_filter('datum.event_index == 0')
@@ -390,84 +540,83 @@ class ChartSpec(DotDict):
                 bind=regional_checkbox, name='hide_regional_icons', init={'values': False}
             )
             hover_layer = hover_layer.add_selection(regional_select)
-        hover_layer = hover_layer.transform_calculate(**calculate_kwargs)
-        layers['hover_layer'] = hover_layer
+        layers = [hover_layer.transform_calculate(**calculate_kwargs)]
         if event_select is not None:
-            layers['event_checkbox_layer'] = _make_base(
+            layers.append(_make_base(
                 f'{lockdown_tooltip_text}:N'
-            ).transform_filter(self._show_events())
+            ).transform_filter(self._show_events()))
+        return layers
 
-    def _collect_tooltip_layers(self, df, layers, base, cursor):
+    def _collect_tooltip_layers(self, df, base, point_layer, cursor):
         if not self.get('has_tooltips', False):
-            return
+            return []
+        layers = []
         if self.get('tooltip_points', False):
-            layers['tooltip_points'] = layers['points'].mark_point(filled=True).encode(
+            layers.append(point_layer.mark_point(filled=True).encode(
                 opacity=alt.condition(cursor, alt.value(1), alt.value(0))
-            ).transform_filter(self._in_focus())
+            ).transform_filter(self._in_focus()))
         if self.get('tooltip_text', False):
-            layers['tooltip_text'] = self._make_tooltip_text_layer(layers['points'], cursor)
+            layers.append(self._make_tooltip_text_layer(point_layer, cursor))
         if self.get('tooltip_rules'):
-            layers['tooltip_rules'] = base.mark_rule(
+            layers.append(base.mark_rule(
                 color='gray'
             ).encode(
                 x='x:Q'
             ).transform_filter(
                 cursor
-            ).transform_filter(self._someone_has_focus())
-        lockdown_base = base.transform_filter(
-            f'datum.x_type == "{self.lockdown_type}"'
-        ).transform_filter(self._in_focus())
-        if 'Coverage' in df.columns:
-            lockdown_base = lockdown_base.transform_filter(
-                f'datum.Coverage == "Statewide" || !{self._hide_regional_icons()}'
-            )
+            ).transform_filter(self._someone_has_focus()))
+        if self.x_type not in df.columns or not (df[self.x_type].values == self.lockdown_type).any():
+            # no lockdown rows means every lockdown layer below would be empty
+            return layers
+        lockdown_base = base.transform_filter(_and(
+            f'datum.x_type == "{self.lockdown_type}"',
+            self._in_focus(),
+            'Coverage' in df.columns and f'(datum.Coverage == "Statewide" || !{self._hide_regional_icons()})',
+        ))
         has_lockdown_rules = self.get('lockdown_rules', False)
         has_lockdown_icons = self.get('lockdown_icons', False)
         if has_lockdown_rules:
-            layers['lockdown_rules'] = self._make_lockdown_rules_layer(lockdown_base)
+            layers.append(self._make_lockdown_rules_layer(lockdown_base))
         if has_lockdown_icons:
-            self._collect_lockdown_icon_layers(df, layers, lockdown_base)
+            layers.extend(self._collect_lockdown_icon_layers(df, lockdown_base))
         if has_lockdown_rules or has_lockdown_icons or self.get('lockdown_tooltips', False):
-            self._collect_lockdown_tooltip_layers(df, layers, lockdown_base, cursor)
-
-    def _make_lockdown_extrapolation_layer(self, base):
-        def _add_model_transformation_fields(base_chart):
-            ret = base_chart.transform_filter(
-                self._show_trends()
-            ).transform_filter(
-                'datum.lockdown_x != null'
-            ).transform_filter(
-                'datum.y !== null'
-            ).transform_filter(
-                'datum.lockdown_y !== null'
-            ).transform_filter(
-                'datum.lockdown_slope !== null'
-            ).transform_filter(
-                'datum.x >= datum.lockdown_x'
-            ).transform_filter(
-                # only show the trend lines if the main lockdown rule appears after the start of the line
-                'datum.lockdown_x > datum.x_start'
-            ).transform_filter(
-                'datum.xmax - datum.lockdown_x >= {}'.format(
-                    self.get('min_trend_line_days', self.DEFAULT_MIN_TREND_LINE_DAYS)
-                )
-            ).transform_calculate(
-                model_y='datum.lockdown_y * pow(datum.lockdown_slope, datum.x - datum.lockdown_x)'
-            )
-            if 'ydomain' in self and self.get('extrap_clip_to_ydomain', False):
-                ret = ret.transform_filter(f'datum.model_y <= {self.ydomain[1]}')
-            return ret
+            layers.extend(self._collect_lockdown_tooltip_layers(df, lockdown_base, cursor))
+        return layers
+
+    def compute_model_y(self, df):
+        """
+        The counterfactual trend for each row, or NaN for rows that shouldn't show a trend line.
+        """
+        min_trend_line_days = self.get('min_trend_line_days', self.DEFAULT_MIN_TREND_LINE_DAYS)
+        has_trend = (
+            df[self.Y].notnull() & df.lockdown_slope.notnull() &
+            (df.x >= df.lockdown_x) &
+            # only show the trend lines if the main lockdown rule appears after the start of the line
+            (df.lockdown_x > df.x_start) &
+            (df.xmax - df.lockdown_x >= min_trend_line_days)
+        )
+        return np.where(
+            has_trend, df.lockdown_y * np.power(df.lockdown_slope, df.x - df.lockdown_x), np.nan
+        )
 
-        ret = _add_model_transformation_fields(
-            base.mark_line(size=5, strokeDash=[1, 1]).encode(
-                x=self._get_x('x:Q'),
-                y=self._get_y('model_y:Q'),
-                detail=self._alt_detail,
-                color=self._alt_color,
-            )
+    @_memoize_per_compile
+    def _trend_line_predicate(self):
+        # model_y is only valid on rows that should show a trend line (see compute_model_y)
+        clip_to_ydomain = 'ydomain' in self and self.get('extrap_clip_to_ydomain', False)
+        return _and(
+            f'({self._show_trends()})',
+            'isValid(datum.model_y)',
+            self._in_focus(),
+            clip_to_ydomain and f'datum.model_y <= {self.ydomain[1]}',
         )
-        ret = ret.transform_filter(self._in_focus())
-        return ret
+
+    def _make_lockdown_extrapolation_layer(self, base):
+        return base.mark_line(size=5, strokeDash=[1, 1]).encode(
+            x=self._get_x('x:Q'),
+            y=self._get_y('model_y:Q'),
+            detail=self._alt_detail,
+            color=self._alt_color,
+        ).transform_filter(self._trend_line_predicate())
 
     def _make_extrapolation_tooltip_layer(self, extrap, cursor, trend_select):
         text = 'extrap_text:N'
@@ -487,30 +636,41 @@ class ChartSpec(DotDict):
             text=text,
             opacity=alt.value(1),
             color=alt.value('black')
-        ).transform_filter(
-            self._show_trends()
         ).transform_calculate(
+            # no need to filter on the trends checkbox again; it's part of the inherited trend line filter
             extrap_text='"Original trend"'
         ).add_selection(trend_select)
 
+    def _unique_values(self, df, col):
+        # several steps of compile need the distinct values of the same column; only scan it once
+        unique_values = self[self.TRANSIENT].unique_values
+        if col not in unique_values:
+            unique_values[col] = pd.unique(df[col].values)
+        return unique_values[col]
+
     def _populate_transient_colormap(self, df):
         colormap = self.get('colormap', None)
         if colormap is None:
             return
         colormap = dict(colormap)
-        color_scheme_idx = 0
+        used_colors = set(colormap.values())
+        # dict.fromkeys dedupes the scheme while keeping its order, so each color is handed out at most once
+        unused_colors = [color for color in dict.fromkeys(self.COLOR_SCHEME) if color not in used_colors]
+        available_colors = iter(unused_colors)
         default_color = self.get('default_color', None)
-        for group in df[self._colorby].unique():
+        for group in self._unique_values(df, self._colorby):
             if group in colormap:
                 continue
             elif default_color is not None:
                 colormap[group] = default_color
                 continue
-            while self.COLOR_SCHEME[color_scheme_idx] in colormap.values():
-                color_scheme_idx += 1
-            colormap[group] = self.COLOR_SCHEME[color_scheme_idx]
-            color_scheme_idx += 1
-        self[self.TRANSIENT]['colormap'] = colormap
+            try:
+                colormap[group] = next(available_colors)
+            except StopIteration:
+                raise ValueError(
+                    f'ran out of colors: max {len(unused_colors)} groups without a color supported for now'
+                ) from None
+        self[self.TRANSIENT].overrides['colormap'] = colormap
 
     def _get_old_legend_title(self):
         readable_group_name = self.get('readable_group_name', None)
@@ -525,27 +685,32 @@ class ChartSpec(DotDict):
         self._populate_transient_colormap(df)
         readable_group_name = self.get('readable_group_name', None)
         if readable_group_name is not None and self.get('legend_selection', False):
-            self[self.TRANSIENT]['colorby'] = self._get_old_legend_title()
-            self[self.TRANSIENT]['detailby'] = self._get_old_legend_title()
+            self[self.TRANSIENT].overrides['colorby'] = self._get_old_legend_title()
+            self[self.TRANSIENT].overrides['detailby'] = self._get_old_legend_title()
 
     def _make_manual_legend(self, df, click_selection):
-        groups = df.groupby(self.colorby).first().reset_index().sort_values(self.colorby, ascending=True)
-        group_names = list(groups[self.colorby].values)
-        if len(group_names) > self.MAX_LEGEND_MARKS:
-            raise ValueError(f'max {self.MAX_LEGEND_MARKS} supported for now ({len(group_names)} requested)')
-        idx = list(self.MAX_LEGEND_MARKS + 1 - np.arange(len(group_names)))
-        row_type = ['normal'] * len(idx)
-        idx.append(self.MAX_LEGEND_MARKS + 2)
-        row_type.append('title')
-        group_names.append(f'Select {self.get("readable_group_name", "line")}')
-        xs = np.zeros_like(idx)
+        # groupby already sorts its keys
+        groups = df.groupby(self.colorby, sort=True).first().reset_index()
+        num_groups = len(groups)
+        if num_groups > self.MAX_LEGEND_MARKS:
+            raise ValueError(f'max {self.MAX_LEGEND_MARKS} supported for now ({num_groups} requested)')
+        # one row per group, followed by the legend title row
+        idx = np.empty(num_groups + 1, dtype=np.int64)
+        idx[:-1] = self.MAX_LEGEND_MARKS + 1 - np.arange(num_groups)
+        idx[-1] = self.MAX_LEGEND_MARKS + 2
+        row_type = np.full(num_groups + 1, 'normal', dtype=object)
+        row_type[-1] = 'title'
+        group_names = np.empty(num_groups + 1, dtype=object)
+        group_names[:-1] = groups[self.colorby].values
+        group_names[-1] = f'Select {self.get("readable_group_name", "line")}'
+        xs = np.zeros(num_groups + 1, dtype=np.int8)
         leg_df = pd.DataFrame({
             'idx': idx,
-            'group_idx': list(groups['group_idx']) + [-1],
+            'group_idx': np.append(groups['group_idx'].values, -1),
             self._colorby: group_names,
-            'x': list(xs),
+            'x': xs,
             'row_type': row_type,
-        })
+        }, copy=False)
 
         axis = alt.Axis(domain=False, ticks=False, orient='right', grid=False, labels=False)
         base = alt.Chart(
@@ -605,73 +770,53 @@ class ChartSpec(DotDict):
         ]
         return alt.layer(*layers, view=alt.ViewConfig(strokeOpacity=0))
 
-    def _collect_emoji_legend_layers(self, df, layers):
-        emojis = list(df['emoji'].dropna().unique())
-        emojis_flattened = []
-        for s in emojis:
-            emojis_flattened.extend([c for c in s])
-
-        def _emoji_gen():
-            cur_emoji = emojis_flattened[0]
-            saw_sep = False
-            for c in emojis_flattened[1:]:
-                if not saw_sep and c not in (u'\u200d', '️'):
-                    yield cur_emoji
-                    cur_emoji = c
-                else:
-                    cur_emoji += c
-                saw_sep = (c in (u'\u200d', '️'))
-            yield cur_emoji
-        emojis = sorted(set(_emoji_gen()) - {'🚫'})
+    def _collect_emoji_legend_layers(self, df):
+        emojis = sorted(set(_EMOJI_RE.findall(''.join(df['emoji'].dropna().unique()))) - {'🚫'})
         if len(emojis) > self.MAX_EMOJI_LEGEND_MARKS:
             raise ValueError(f'max {self.MAX_EMOJI_LEGEND_MARKS} supported for now')
-        idx = list(np.arange(len(emojis) + 1))
+        if not emojis:
+            return []
+        idx = np.arange(len(emojis) + 1)
         row_type = ['normal'] * len(emojis) + ['title']
         emojis.append('Intervention type')
-        leg_df = pd.DataFrame({'idx': idx, 'emoji': emojis, 'zero': np.zeros_like(idx), 'row_type': row_type})
+        leg_df = pd.DataFrame({
+            'idx': idx, 'emoji': emojis, 'zero': np.zeros(len(idx), dtype=np.int8), 'row_type': row_type
+        })
         base = alt.Chart(
             leg_df, height=self._height, width=self._width,
         ).encode(
             color=alt.value('black'),
         )
-        layers['marks'] = base.mark_text(
+        layers = []
+        layers.append(base.mark_text(
             align='left', font=self._font, fontSize=12,
         ).encode(
             x=self._get_x(),
             y=self._get_y(),
             text='emoji_and_description:N',
         ).transform_calculate(
-            emoji_and_description='datum.emoji + " " + {'
-                                  '"👨‍👩‍👧‍👦": "Gatherings banned", '
-                                  '"🏠": "Stay-at-home order", '
-                                  '"🍔": "Restaurant closures", '
-                                  '"🏬": "Business closures", '
-                                  '"⚠️": "Emergency declaration", '
-                                  '"🎓": "School closures", '
-                                  '"🛩": "Travel restrictions", '
-                                  '"💼": "Visitor/Border restrictions", '
-                                  '"🛃": "Forgot what this meant", '
-                                  '}[datum.emoji]'
+            emoji_and_description=_EMOJI_AND_DESCRIPTION_EXPR
         ).transform_filter(
             'datum.row_type == "normal"'
         ).transform_calculate(
             x=f'5 + (datum.idx % 3) * {self.xdomain[1]//4 + 2}',
             y='1.5 * pow(1.7, floor(datum.idx / 3))'
-        )
+        ))
         num_emoji_rows = (len(emojis) + 2) // 3
-        layers['emoji_legend_sep'] = base.mark_rule(
+        layers.append(base.mark_rule(
             strokeWidth=0.5,
             strokeDash=[1, 0]
         ).encode(
             y=self._get_y(),
             color=alt.value('gray')
-        ).transform_calculate(y={1: '2', 2: '4', 3: '7'}[num_emoji_rows])
-        # layers['title'] = base.mark_text(
+        ).transform_calculate(y=_EMOJI_LEGEND_SEP_Y[num_emoji_rows]))
+        # layers.append(base.mark_text(
         #     align='left', dy=-5, font=self._font, fontSize=16,
         # ).encode(
         #     text='emoji:N',
         #     color=alt.value('black'),
-        # ).transform_filter('datum.row_type == "title"')
+        # ).transform_filter('datum.row_type == "title"'))
+        return layers
 
     # def _make_day_0_warning_layer(self, df):
     #     groups = df.groupby(self.colorby).first().reset_index().sort_values(self.colorby, ascending=True)
@@ -684,24 +829,67 @@ class ChartSpec(DotDict):
     #         self._colorby: group_names,
     #     })
 
+    def _compile_cache_key(self, df):
+        try:
+            spec_items = _hashable_spec_value({k: v for k, v in self.items() if k != self.TRANSIENT})
+            df_hash = hashlib.sha1(pd.util.hash_pandas_object(df, index=True).values.tobytes()).hexdigest()
+        except TypeError:
+            # spec values we can't reliably compare (e.g. arrays), or unhashable cells; just don't cache
+            return None
+        return type(self), spec_items, tuple(df.columns), tuple(df.dtypes.astype(str)), df_hash
+
     def compile(self, df):
-        self.validate(df)
-        self[self.TRANSIENT] = DotDict()
+        cache_key = self._compile_cache_key(df)
+        if cache_key is None:
+            return self._compile(df)
+        cache = self._compile_cache
+        with self._compile_cache_lock:
+            final_chart = cache.get(cache_key)
+            if final_chart is not None:
+                cache.move_to_end(cache_key)
+        if final_chart is None:
+            # build from a private copy so later changes to the caller's df can't leak in
+            final_chart = self._compile(df.copy())
+            with self._compile_cache_lock:
+                cache[cache_key] = final_chart
+                while len(cache) > self.COMPILE_CACHE_SIZE:
+                    cache.popitem(last=False)
+        # callers may modify the returned chart (layers, encodings, data, ...); keep the cached one pristine
+        return _copy_chart_data(final_chart.copy(deep=True))
+
+    @contextlib.contextmanager
+    def _transient_scope(self):
+        self[self.TRANSIENT] = _TransientState()
         try:
+            yield
+        finally:
+            del self[self.TRANSIENT]
+
+    def _compile(self, df):
+        self.validate(df)
+        if (
+            self.get('lockdown_extrapolation', True) and 'model_y' not in df.columns
+            and all(col in df.columns for col in self.MODEL_Y_INPUT_COLUMNS)
+        ):
+            # CovidChart precomputes this; fill it in for dataframes that come from elsewhere
+            df = df.assign(model_y=self.compute_model_y(df))
+        with self._transient_scope():
             self._populate_transient_props(df)
+            # everything below only depends on state that is fixed from here until the end of compile
+            self[self.TRANSIENT].memo = {}
             base = alt.Chart(
-                df,
+                _to_inline_csv(df) if self.get('inline_csv', False) else df,
                 width=self._width,
                 height=self._height
             )
-            layers = {}
+            layers = []
 
             extra_click_selection_kwargs = {}
             if not self._manual_legend:
                 dropdown_options = [self.EMPTY_SELECTION]
                 dropdown_name = " "
                 if self.get('click_selection', False):
-                    dropdown_options.extend(list(df[self._detailby].unique()))
+                    dropdown_options.extend(self._unique_values(df, self._detailby))
                     dropdown_name = f'Select {self.get("readable_group_name", self.get("detailby", "group"))}: '
                 dropdown = alt.binding_select(options=dropdown_options, name=dropdown_name)
                 extra_click_selection_kwargs['bind'] = dropdown
@@ -721,35 +909,36 @@ class ChartSpec(DotDict):
                 **extra_click_selection_kwargs
             )
 
-            # put a fake layer in first with no click selection
-            # since it has X and Y, it will help chart.interactive() to find x and y fields to bind to,
-            # allowing us to pan up and down and zoom over both axes instead of just 1.
-            layers['fake_interactive'] = base.mark_line().encode(
-                x=self._get_x(), y=self._get_y()
-            ).transform_filter('false')
-
             # The first layer with a specified color channel is used to generate the legend.
             # as such, we need to make sure the marks in the first layer w/ specified color channel are not translucent,
             # otherwise we'll get a blank legend.
             # We put a fake layer in here before we add any other layers w/ color channel specified, and we
             # furthermore add the legend selection to it b/c it also seems like a multi-selection bound to the
             # legend needs to be added to the layer that generates the legend.
+            # With a single color group there is nothing to pick from the legend, so skip the fake layer
+            # and let the line layer carry the legend selection (the focus predicates still refer to it).
+            line_legend_selection = None
             if not self._manual_legend:
                 legend_selection = alt.selection_multi(
                     fields=[self._colorby], on='click', name=self.legend, empty='all',
                     bind='legend', clear='dblclick',
                 )
-                layers['legend'] = base.mark_point(size=0).encode(
-                    x=self._get_x(), y=self._get_y(), color=self._alt_color
-                ).add_selection(legend_selection)
+                if len(self._unique_values(df, self._colorby)) > 1:
+                    layers.append(_set_selections(base.mark_point(size=0).encode(
+                        x=self._get_x(), y=self._get_y(), color=self._alt_color
+                    ), legend_selection))
+                else:
+                    line_legend_selection = legend_selection
 
             extra_mouseover_kwargs = {}
+            cursor_events = _CURSOR_EVENTS
             if self._manual_legend:
                 # don't set clear for selection_single click --
                 # it will disappear when mouse is over points
                 extra_mouseover_kwargs['clear'] = 'mouseout'
+                cursor_events = 'mouseover'
             cursor = alt.selection_single(name=self.cursor, nearest=True,
-                                          on='mouseover', fields=['x'],
+                                          on=cursor_events, fields=['x'],
                                           empty='none', **extra_mouseover_kwargs)
 
             # Next goes the mouseover interaction layer (needs to happen before click selection layer,
@@ -758,8 +947,12 @@ class ChartSpec(DotDict):
             # that make use of the hover interaction need to use this column for their x encoding in Altair.
             # This means that things like lockdown tooltips need to use 'x' and then apply a filter to filter
             # out non-lockdown days if they want work with the mouseover interaction.
+            # The cursor only cares about x, so one invisible rule per distinct x value is enough to host it;
+            # it's built from every row, so that x values which are only present on filtered out rows
+            # (e.g. lockdown events) can still be hovered.
+            cursor_layer = base.transform_aggregate(groupby=[self.X]).mark_rule(opacity=0).encode(x=self._get_x())
             if not self._manual_legend:
-                layers['selectors'] = base.mark_point(size=0).encode(x=self._get_x()).add_selection(cursor)
+                layers.append(_set_selections(cursor_layer, cursor))
 
             # Put a fake layer in first to attach the click selection to. We use a fake layer for a few reasons.
             # 1. It's not used as a base layer, so we won't get errors
@@ -769,58 +962,63 @@ class ChartSpec(DotDict):
             #    need to be translucent, this layer cannot be the first layer that specifies color channel
             #    and similarly cannot be the layer with the legend_selection added on (in the case of using
             #    the built-in legend from Altair, which is only true if `use_manual_legend` is False).
-            layers['fake_points'] = self._make_point_layer(
-                base, point_size=400, is_fake=True
-            ).add_selection(click_selection)
+            layers.append(_set_selections(
+                self._make_point_layer(base, point_size=400, is_fake=True), click_selection
+            ))
 
             # Mouseover interaction goes after click interaction layer for manual legend, since manual legend
             # uses `selection_multi` for the click layer which does not stick if going later (and does not appear
             # at all if it goes first).
             if self._manual_legend:
-                layers['selectors'] = self._make_point_layer(
-                    base, point_size=0, is_fake=True
-                ).add_selection(cursor)
+                layers.append(_set_selections(cursor_layer, cursor))
 
             # now the meaty layers with actual content
-            layers['lines'] = self._make_line_layer(base)
-            layers['points'] = self._make_point_layer(
+            line_selections = []
+            if line_legend_selection is not None:
+                line_selections.append(line_legend_selection)
+            if self.get('interactive', False):
+                # the line layer has X and Y and no click selection, so binding the scales here lets us
+                # pan up and down and zoom over both axes instead of just 1 (the scales are shared by all layers).
+                # This is the selection chart.interactive(bind_x=True, bind_y=True) would add.
+                pan_zoom = alt.selection_interval(bind='scales', encodings=['x', 'y'], name='pan_zoom')
+                line_selections.append(pan_zoom)
+            line_layer = self._make_line_layer(base)
+            if line_selections:
+                line_layer = _set_selections(line_layer, *line_selections)
+            layers.append(line_layer)
+            point_layer = self._make_point_layer(
                 base,
                 point_size=self.get('point_size', self.DEFAULT_POINT_SIZE),
                 is_fake=False
             )
+            layers.append(point_layer)
 
-            self._collect_tooltip_layers(df, layers, base, cursor)
+            layers.extend(self._collect_tooltip_layers(df, base, point_layer, cursor))
 
             if self.get('lockdown_extrapolation', True):
+                model_lines = self._make_lockdown_extrapolation_layer(base)
+                layers.append(model_lines)
                 trend_checkbox = alt.binding_checkbox(name='Show trend lines for selected ')
                 trend_select = alt.selection_single(bind=trend_checkbox, name='trends', init={'values': False})
-                
-                layers['model_lines'] = self._make_lockdown_extrapolation_layer(base)
-                layers['model_tooltip'] = self._make_extrapolation_tooltip_layer(
-                    layers['model_lines'], cursor, trend_select
-                )
+                layers.append(self._make_extrapolation_tooltip_layer(model_lines, cursor, trend_select))
             
             if self.get('emoji_legend', False):
-                self._collect_emoji_legend_layers(df, layers)
+                layers.extend(self._collect_emoji_legend_layers(df))
 
-            layered = alt.layer(*layers.values())
+            layered = alt.layer(*layers)
             layered = self._maybe_add_facet(layered)
-            if self.get('interactive', False):
-                layered = layered.interactive(bind_x=True, bind_y=True)
             if self.get('title', False):
                 layered.title = self.get('title')
             final_chart = layered
             if self._manual_legend:
                 final_chart = alt.hconcat(final_chart, self._make_manual_legend(df, click_selection), spacing=0)
-            final_chart = final_chart.configure(background=self.get('background', self.DEFAULT_BACKGROUND_COLOR))
-            final_chart = final_chart.configure_axis(
-                titleFontSize=self.get('axes_title_fontsize', self.DEFAULT_AXES_TITLE_FONTSIZE),
-            )
-            final_chart = final_chart.configure_title(font=self._font)
+            # the fonts go in the chart's own config (and not just the theme), so that rendering
+            # doesn't depend on which font theme happens to be active when to_dict() is called
+            config = _fontConfig(self._font)
+            config['background'] = self.get('background', self.DEFAULT_BACKGROUND_COLOR)
+            config['axis']['titleFontSize'] = self.get('axes_title_fontsize', self.DEFAULT_AXES_TITLE_FONTSIZE)
             if not self._manual_legend:
-                final_chart = final_chart.configure_legend(symbolType='diamond')
-            alt.themes.register('customFont', _fontSettings(self._font))
-            alt.themes.enable('customFont')
+                config['legend']['symbolType'] = 'diamond'
+            # final_chart was created above and isn't shared, so set its config in place rather than copying
+            final_chart.config = alt.Config(**config)
             return final_chart
-        finally:
-            del self[self.TRANSIENT]
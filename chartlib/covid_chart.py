@@ -276,6 +276,10 @@ class CovidChart(object):
         )
         df['lockdown_slope'] = np.power(df.lockdown_y / df.y_start, 1. / (df.lockdown_x - df.x_start))
 
+        # compute the counterfactual trend once here instead of per row / per layer in vega;
+        # rows that shouldn't show a trend line get a null model_y
+        df['model_y'] = self.spec.compute_model_y(df)
+
         # these new rows are to ensure we have at least one point where x == lockdown_x since this is the filter
         # used to generate lockdown rules...
         # we need this b/c we can only attach mouseover interactions to one column, and it is already attached to x
@@ -361,7 +365,7 @@ class CovidChart(object):
         if self.quarantine_df is not None:
             df = self._preprocess_lockdown_info(df)
 
-        groups = df.groupby(self.groupcol).first().reset_index().sort_values(self.groupcol)
+        groups = df.groupby(self.groupcol, sort=True).first().reset_index()
         groups['group_idx'] = np.arange(len(groups[self.groupcol]))
         df = df.merge(
             groups[[self.groupcol, 'group_idx']],
@@ -477,6 +481,10 @@ class CovidChart(object):
         self.spec.interactive = interactive
         return self
 
+    def set_inline_csv(self, inline_csv=True):
+        self.spec.inline_csv = inline_csv
+        return self
+
     def colorby(self, col):
         self.spec.colorby = col
         return self
@@ -354,4 +354,4 @@ def strip_nans(x):
 
 
 def split_into_list(word):
-    return [char for char in word]
+    return list(word)
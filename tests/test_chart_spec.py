@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from chartlib.chart_spec import ChartSpec
+
+
+@pytest.fixture(autouse=True)
+def empty_compile_cache():
+    ChartSpec._compile_cache.clear()
+    yield
+    ChartSpec._compile_cache.clear()
+
+
+def make_df():
+    rows = []
+    for state in ['Alpha', 'Beta']:
+        for x in range(5):
+            rows.append(dict(state=state, x=x, y=float(2 ** x), x_type='normal'))
+    return pd.DataFrame(rows)
+
+
+def make_spec(**kwargs):
+    spec = dict(
+        detailby='state', colorby='state', lines=True, points=True, click_selection=True,
+        lockdown_extrapolation=False, width=600, height=400,
+    )
+    spec.update(kwargs)
+    return ChartSpec(**spec)
+
+
+def test_compile_cache_hit():
+    first = make_spec().compile(make_df())
+    second = make_spec().compile(make_df())
+    assert len(ChartSpec._compile_cache) == 1
+    assert first is not second
+    assert first.to_dict() == second.to_dict()
+
+
+def test_compile_cache_miss():
+    first = make_spec().compile(make_df()).to_dict()
+    df = make_df()
+    df.loc[0, 'y'] = 100.
+    second = make_spec().compile(df).to_dict()
+    third = make_spec(point_size=10).compile(make_df()).to_dict()
+    assert len(ChartSpec._compile_cache) == 3
+    assert first != second
+    assert first != third
+
+
+def test_compile_cache_isolates_returned_charts():
+    expected = make_spec().compile(make_df()).to_dict()
+    chart = make_spec().compile(make_df())
+    chart.layer[0].mark = 'bar'
+    chart.layer[0].encoding.x.title = 'changed'
+    assert make_spec().compile(make_df()).to_dict() == expected
+
+
+def test_compile_cache_skips_unhashable_spec_values():
+    make_spec(xdomain=np.array([0, 10])).compile(make_df())
+    assert len(ChartSpec._compile_cache) == 0
+
+
+def test_compile_cache_isolates_returned_data():
+    expected = make_spec().compile(make_df()).to_dict()
+    chart = make_spec().compile(make_df())
+    chart.data.loc[0, 'y'] = 100.
+    assert make_spec().compile(make_df()).to_dict() == expected
+
+
+def test_compile_cache_isolates_returned_manual_legend_data():
+    df = make_df()
+    df['group_idx'] = (df.state == 'Beta').astype(int)
+    spec_kwargs = dict(use_manual_legend=True)
+    expected = make_spec(**spec_kwargs).compile(df).to_dict()
+    chart = make_spec(**spec_kwargs).compile(df)
+    chart.hconcat[1].data['state'] = 'changed'
+    assert make_spec(**spec_kwargs).compile(df).to_dict() == expected
+
+
+def test_compile_cache_keys_on_spec_class():
+    class OtherSpec(ChartSpec):
+        pass
+    make_spec().compile(make_df())
+    OtherSpec(**make_spec()).compile(make_df())
+    assert len(ChartSpec._compile_cache) == 2
+
+
+def test_compile_runs_out_of_colors():
+    class OneColorSpec(ChartSpec):
+        COLOR_SCHEME = ['red']
+    spec = OneColorSpec(**make_spec(colormap={'Alpha': 'red'}))
+    with pytest.raises(ValueError, match='ran out of colors'):
+        spec.compile(make_df())
+
+
+def make_lockdown_df(**kwargs):
+    df = make_df()
+    df['lockdown_x'] = 1.
+    df['lockdown_y'] = 2.
+    df['lockdown_slope'] = 1.5
+    df['x_start'] = 0.
+    df['xmax'] = 10.
+    for col, value in kwargs.items():
+        df[col] = value
+    return df
+
+
+def test_compute_model_y():
+    df = make_lockdown_df()
+    model_y = ChartSpec().compute_model_y(df)
+    expected = np.where(df.x >= 1, 2. * 1.5 ** (df.x - 1), np.nan)
+    np.testing.assert_allclose(model_y, expected)
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(lockdown_x=np.nan, lockdown_y=np.nan),
+    dict(lockdown_slope=np.nan),
+    dict(x_start=1.),
+    dict(xmax=5.),
+])
+def test_compute_model_y_without_trend(kwargs):
+    assert np.isnan(ChartSpec().compute_model_y(make_lockdown_df(**kwargs))).all()
+
+
+def test_compute_model_y_min_trend_line_days():
+    df = make_lockdown_df(xmax=5.)
+    assert np.isnan(ChartSpec(min_trend_line_days=5).compute_model_y(df)).all()
+    assert not np.isnan(ChartSpec(min_trend_line_days=4).compute_model_y(df)).all()
+
+
+def test_compile_fills_in_model_y():
+    df = make_lockdown_df()
+    chart = make_spec(lockdown_extrapolation=True).compile(df)
+    assert 'model_y' not in df.columns
+    np.testing.assert_allclose(chart.data['model_y'], ChartSpec().compute_model_y(df))
+
+
+def test_compile_keeps_precomputed_model_y():
+    df = make_lockdown_df()
+    df['model_y'] = 3.
+    chart = make_spec(lockdown_extrapolation=True).compile(df)
+    assert (chart.data['model_y'] == 3.).all()